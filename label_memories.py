@@ -1,24 +1,70 @@
 import streamlit as st
 import json
+import functools
+import hashlib
 import html
+import io
 import os
+import re
 from datetime import datetime, timezone
 from typing import List, Dict, Any, Optional
 
+try:
+    import orjson
+except ImportError:  # Fall back to the stdlib parser when orjson isn't installed
+    orjson = None
+
+if orjson is not None:
+    def _dumps(obj) -> bytes:
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            # Integers past 64 bits and lone surrogates, which the stdlib encoder still accepts
+            return json.dumps(obj).encode('utf-8')
+else:
+    def _dumps(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+
 # --- Configuration ---
 LABEL_CLASSIFICATIONS = [
     "Correct 👍",
     "Incorrect 👎",
     "I'm not sure 🤔",
 ]
+_CLASSIFICATION_INDEX = {label: i for i, label in enumerate(LABEL_CLASSIFICATIONS)}
 DEFAULT_OUTPUT_FILENAME = "alerts_labeled_tp_fp_tn_fn.jsonl"
 READABLE_TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
 BRAND_COLOR = "#df0074"  # Visory signature pink color
 
+# Shared read-only default for missing record fields, so lookups don't allocate on the miss path
+_EMPTY_TUPLE = ()
+
+# Digit runs long enough to be an integer past 64 bits, which orjson would silently coerce to float
+_LONG_INT_RE = {str: re.compile(r'[0-9]{19}'), bytes: re.compile(rb'[0-9]{19}')}
+
+# Runs of whitespace collapsed by normalize_whitespace
+_WS_RE = re.compile(r'\s+')
+
+# HTML escaping for the LLM output, applied in a single translate pass
+_HTML_ESC = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;'})
+
+# MEMORY tag highlighting for the escaped output, applied in a single substitution pass
+_MEM_TAG_RE = re.compile(r'(&lt;MEMORY|&lt;/MEMORY&gt;)')
+_MEM_TAG_SUB = {
+    "&lt;MEMORY": f"<span style='color:{BRAND_COLOR};font-weight:bold;'>&lt;MEMORY",
+    "&lt;/MEMORY&gt;": "&lt;/MEMORY&gt;</span>",
+}
+
+# Opening tag for speaker names in the chat history
+_NAME_OPEN = f"<span style='color:{BRAND_COLOR};font-weight:bold;'>"
+
+# Opening tags for the brand-colored section headers
+_H3_OPEN = f"<h3 style='color:{BRAND_COLOR};'>"
+_H4_OPEN = f"<h4 style='color:{BRAND_COLOR};'>"
+
 # --- Custom styling with the brand color ---
-def apply_custom_styling():
-    # Apply brand colors to various elements
-    st.markdown(f"""
+# Built once at import; none of it depends on session state
+_CUSTOM_CSS = f"""
     <style>
         /* Brand color for headers */
         h1, h2, h3, h4, h5, h6 {{
@@ -67,54 +113,105 @@ def apply_custom_styling():
         .sidebar .sidebar-content h2 {{
             color: {BRAND_COLOR} !important;
         }}
+        
+        /* Brand-colored border on the label text areas */
+        div[data-testid="stTextArea"] textarea {{
+            border-left: 2px solid {BRAND_COLOR} !important;
+        }}
     </style>
-    """, unsafe_allow_html=True)
+"""
+
+_WELCOME_HTML = f"""
+    <h1 style='color:{BRAND_COLOR};'>Visory AI Memory Labelling Tool</h1>
+    <h2 style='color:{BRAND_COLOR};text-align:center;'>🌟 Welcome to Visory's Delphi AI Memory Labelling Tool! 🌟</h2>
+"""
+
+_INSTRUCTIONS_HTML = f"""
+        <p>Hi there, valued expert! We're excited you're here to help Delphi, our clever AI assistant, get smarter at recognising useful memories.</p>
+        
+        <p style='color:{BRAND_COLOR};font-weight:bold;margin-top:20px;'>🚀 How to Jump In:</p>
+        <p>1. <b>📁 Upload Your Document</b> Use the sidebar on the left to upload your JSONL file. Each line should be a neatly formatted JSON object representing an AI conversation.</p>
+        
+        <p>2. <b>🔍 Review Delphi's Memory</b> You'll see one memory at a time, including Delphi's determination about whether it's useful.</p>
+        
+        <p>3. <b>✅ Label Delphi's Decision</b> Help Delphi learn by telling it how it did, then click <b>Save</b>:</p>
+        <p style='margin-left:20px;'><b>Correct 👍</b>: Delphi nailed it!</p>
+        <p style='margin-left:20px;'><b>Incorrect 👎</b>: Delphi missed the mark.</p>
+        <p style='margin-left:20px;'><b>I'm not sure 🤔</b>: If it's unclear, that's totally fine!</p>
+        
+        <p>4. <b>💬 Optional Critiques</b> If you'd like, you can leave notes to explain your choice or provide helpful feedback. Your insights are gold to us!</p>
+        
+        <p>5. <b>↔️ Easy Navigation</b> Click the <b>Right Arrow</b> ➡️ to move forward and the <b>Left Arrow</b> ⬅️ to revisit previous entries.</p>
+        
+        <p>6. <b>📥 All Done? Download & Submit!</b> Once you've reviewed all memories, hit <b>"Download Labelled Data"</b>. Then simply email the file to <b>Ben Field at ben.field@visory.com.au</b>.</p>
+        
+        <p style='text-align:center;margin-top:20px;'><b>🎉 Thank you for lending your expertise! Together, we're making Delphi even more brilliant! 🎉</b></p>
+"""
+
+_FOOTER_HTML = f"""
+    <div style='text-align:center;margin-top:30px;padding-top:10px;border-top:1px solid #eee;'>
+        <p style='color:#666;font-size:0.8rem;'>
+            Visory AI Alert Labeling Tool | <span style='color:{BRAND_COLOR};'>Your feedback improves our system</span>
+        </p>
+    </div>
+"""
+
+def apply_custom_styling():
+    # Apply brand colors to various elements
+    st.html(_CUSTOM_CSS)
 
 # --- Helper Functions ---
 
-@st.cache_data
+def _utc_now_iso() -> str:
+    """Current UTC time as ISO 8601 with millisecond precision and a 'Z' suffix."""
+    now = datetime.now(timezone.utc)
+    return now.strftime('%Y-%m-%dT%H:%M:%S.') + f"{now.microsecond // 1000:03d}Z"
+
 def load_data_and_labels(uploaded_file):
     """
     Loads data from the uploaded JSONL file.
     If the file contains existing labels, it extracts them.
     Returns both the list of data records and a dictionary of labels.
     """
+    if uploaded_file is None:
+        return [], {}  # Return empty if no file
+    # Key the parse cache on the file contents so re-uploading the same file skips the parse
+    data_bytes = uploaded_file.getvalue()
+    file_key = hashlib.blake2b(data_bytes, digest_size=16).hexdigest()
+    return _parse_bytes(file_key, data_bytes)
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def _parse_bytes(file_key, _data_bytes):
+    """
+    Parses raw JSONL bytes into data records and existing labels.
+    Cached in memory on file_key, a content hash; the leading underscore keeps Streamlit from hashing the bytes again.
+    """
     data = []
     loaded_labels = {}  # Dictionary to store labels found in the file
-    if uploaded_file is not None:
+    now_iso = _utc_now_iso()  # Default timestamp for loaded labels that lack one
+    if _data_bytes:
         try:
-            uploaded_file.seek(0)
-            lines = uploaded_file.readlines()
-            # Hide technical messages from users
-            for i, line_bytes in enumerate(lines):
-                try:
-                    line_str = line_bytes.decode('utf-8').strip()
-                    if line_str:
-                        record = json.loads(line_str)
-                        
-                        # Process the record to match our expected structure
-                        processed_record = transform_record(record)
-                        if processed_record:
-                            data.append(processed_record)
-
-                            # Check for and extract existing labels
-                            record_id = processed_record.get("observation_id")
-                            if record_id and "human_label_classification" in processed_record:
-                                loaded_labels[record_id] = {
-                                    "human_label_timestamp": processed_record.get("human_label_timestamp", datetime.now(timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z')),
-                                    "human_label_classification": processed_record.get("human_label_classification", LABEL_CLASSIFICATIONS[-1]),
-                                    "human_label_critique": processed_record.get("human_label_critique", ""),
-                                    "human_label_correct_memory_optional": processed_record.get("human_label_correct_memory_optional", ""),
-                                }
-                except json.JSONDecodeError:
-                    # Silently skip invalid JSON without showing warnings
-                    pass
-                except UnicodeDecodeError:
-                    # Silently skip decoding errors without showing warnings
-                    pass
-                except Exception as e:
-                    # Silently handle errors without showing warnings
-                    pass
+            # Stream the upload one line at a time rather than materialising every line up front.
+            # Both parsers accept raw bytes, so lines are never decoded separately.
+            # Invalid lines come back as None from _transform_line and are silently skipped,
+            # so the happy path carries no per-line exception handling.
+            lines = (line_bytes.strip() for line_bytes in io.BytesIO(_data_bytes))
+            records = (_transform_line(line_bytes) for line_bytes in lines if line_bytes)
+            append = data.append
+            for processed_record in records:
+                if not processed_record:
+                    continue
+                append(processed_record)
+
+                # Check for and extract existing labels
+                record_id = processed_record.get("observation_id")
+                if record_id and "human_label_classification" in processed_record:
+                    loaded_labels[record_id] = {
+                        "human_label_timestamp": processed_record.get("human_label_timestamp", now_iso),
+                        "human_label_classification": processed_record.get("human_label_classification", LABEL_CLASSIFICATIONS[-1]),
+                        "human_label_critique": processed_record.get("human_label_critique", ""),
+                        "human_label_correct_memory_optional": processed_record.get("human_label_correct_memory_optional", ""),
+                    }
 
             # No summary messages after processing
 
@@ -124,10 +221,69 @@ def load_data_and_labels(uploaded_file):
             # Only show error for critical failures
             st.error("There was a problem loading the file. Please make sure it's a valid JSONL file.")
             return [], {}  # Return empty on major failure
-    return [], {}  # Return empty if no file
+    return [], {}  # Return empty if the file is empty
+
+def _safe_loads(payload):
+    """
+    Parse a JSON payload, returning None if it is missing or isn't valid JSON.
+    orjson handles the common case; anything it rejects or would alter (NaN/Infinity, lone surrogates,
+    integers past 64 bits, invalid UTF-8) goes through the stdlib parser as before.
+    """
+    if payload is None:
+        return None
+    if orjson is not None and not _LONG_INT_RE[type(payload)].search(payload):
+        try:
+            return orjson.loads(payload)
+        except ValueError:
+            pass
+    try:
+        if isinstance(payload, bytes):
+            # Replace invalid UTF-8 the way the original text reader did
+            payload = payload.decode('utf-8', 'replace')
+        return json.loads(payload)
+    except ValueError:
+        return None
+
+def _extract_array(content, start):
+    """Returns the text from the first '[' at or after start through the last ']', or None."""
+    open_idx = content.find("[", start)
+    close_idx = content.rfind("]") + 1
+    if open_idx < 0 or close_idx <= open_idx:
+        return None
+    return content[open_idx:close_idx]
+
+def _extract_codeblock(content, start):
+    """Returns the text between the first pair of ``` fences at or after start, or None."""
+    open_idx = content.find("```", start)
+    if open_idx < 0:
+        return None
+    body_idx = open_idx + 3
+    close_idx = content.find("```", body_idx)
+    if close_idx < 0:
+        return None
+    # Only the final payload is sliced out; the searches work on offsets into content
+    return content[body_idx:close_idx]
+
+def _transform_line(line_bytes: bytes):
+    """
+    Parses and transforms one JSONL line.
+    Returns None for lines that aren't a valid JSON object.
+    """
+    record = _safe_loads(line_bytes)
+    if not isinstance(record, dict):
+        return None
+    processed_record = transform_record(record)
+    if processed_record is not None:
+        # Digest of the raw line, so the per-record render caches are keyed on content rather than observation_id
+        processed_record["_content_key"] = hashlib.blake2b(line_bytes, digest_size=16).hexdigest()
+    return processed_record
 
 def transform_record(record):
-    """Transform the record from your JSON format to the expected format for the labeling tool."""
+    """
+    Transform the record from your JSON format to the expected format for the labeling tool.
+    Only the cheap fields are pulled out here; the prompt messages are kept raw and parsed
+    by _extract_context when a record is actually viewed or exported.
+    """
     try:
         # Extract basic info - use the appropriate fields from your data
         observation_id = record.get("id") or record.get("traceId") 
@@ -138,92 +294,23 @@ def transform_record(record):
         llm_output = ""
         if "output" in record:
             llm_output = record["output"]
-        
-        # Extract system prompts
-        system_prompt = ""
-        if "input" in record and "messages" in record["input"]:
-            for msg in record["input"]["messages"]:
-                if msg.get("role") == "system":
-                    system_prompt += msg.get("content", "") + "\n\n"
-        
-        # Try to extract chat history
-        chat_history = []
-        try:
-            # Look for chat history in different possible locations
-            if "input" in record and "messages" in record["input"]:
-                for msg in record["input"]["messages"]:
-                    content = msg.get("content", "")
-                    if "Chat history" in content and "[" in content and "]" in content:
-                        # Try to extract the JSON array from the content
-                        start_idx = content.find("[")
-                        end_idx = content.rfind("]") + 1
-                        if start_idx > 0 and end_idx > start_idx:
-                            try:
-                                history_str = content[start_idx:end_idx]
-                                extracted_history = json.loads(history_str)
-                                if isinstance(extracted_history, list):
-                                    chat_history = extracted_history
-                            except:
-                                pass
-        except Exception as e:
-            st.warning(f"Error extracting chat history: {e}")
-        
-        # Extract existing memories
-        existing_memories = []
-        try:
-            if "input" in record and "messages" in record["input"]:
-                for msg in record["input"]["messages"]:
-                    content = msg.get("content", "")
-                    if "Current memories" in content and "```" in content:
-                        # Try to extract the JSON array from between the code blocks
-                        start_idx = content.find("```") + 3
-                        content = content[start_idx:]
-                        end_idx = content.find("```")
-                        if end_idx > 0:
-                            try:
-                                memories_str = content[:end_idx].strip()
-                                extracted_memories = json.loads(memories_str)
-                                if isinstance(extracted_memories, list):
-                                    existing_memories = extracted_memories
-                            except:
-                                pass
-        except Exception as e:
-            st.warning(f"Error extracting existing memories: {e}")
-        
-        # Extract chat metadata
-        chat_metadata = {}
-        try:
-            if "input" in record and "messages" in record["input"]:
-                for msg in record["input"]["messages"]:
-                    content = msg.get("content", "")
-                    if "Chat metadata" in content and "```" in content:
-                        # Try to extract the JSON object from between the code blocks
-                        start_idx = content.find("```") + 3
-                        content = content[start_idx:]
-                        end_idx = content.find("```")
-                        if end_idx > 0:
-                            try:
-                                metadata_str = content[:end_idx].strip()
-                                extracted_metadata = json.loads(metadata_str)
-                                if isinstance(extracted_metadata, dict):
-                                    chat_metadata = extracted_metadata
-                            except:
-                                pass
-        except Exception as e:
-            st.warning(f"Error extracting chat metadata: {e}")
-        
+
         # Determine alert type based on the presence of <MEMORY> tags in the output
         alert_type = "memory" if "<MEMORY" in llm_output else "no_memory"
             
+        # Keep the raw prompt messages only when they have the expected shape; records with
+        # any other "input" still load, just without prompt context
+        raw_input = record.get("input")
+        raw_messages = raw_input.get("messages") if isinstance(raw_input, dict) else None
+        if not isinstance(raw_messages, list):
+            raw_messages = _EMPTY_TUPLE
+
         # Construct the transformed record with all needed fields
         transformed_record = {
             "observation_id": observation_id,
             "llm_output": llm_output,
-            "system_prompt": system_prompt,
-            "chat_history": chat_history,
-            "existing_memories": existing_memories,
-            "chat_metadata": chat_metadata,
             "alert_type": alert_type,
+            "_raw_messages": raw_messages,
             # Add any other fields you might need
         }
         
@@ -233,6 +320,69 @@ def transform_record(record):
         st.warning(f"Error transforming record: {e}")
         return None
 
+def _extract_context(messages):
+    """
+    Extracts the system prompt, chat history, existing memories and chat metadata
+    from a record's prompt messages in a single pass.
+    """
+    system_parts = []
+    chat_history = []
+    existing_memories = []
+    chat_metadata = {}
+    try:
+        for msg in messages:
+            content = msg.get("content", "") if isinstance(msg, dict) else None
+            # Skip messages without plain-text content (e.g. null tool-call turns or content-part lists)
+            # so one odd message doesn't abort the scan for the rest
+            if not isinstance(content, str):
+                continue
+            if msg.get("role") == "system":
+                system_parts.append(content)
+            # JSON array following the "Chat history" marker
+            if not chat_history:
+                marker_idx = content.find("Chat history")
+                if marker_idx >= 0:
+                    extracted_history = _safe_loads(_extract_array(content, marker_idx))
+                    if isinstance(extracted_history, list):
+                        chat_history = extracted_history
+            # JSON array inside the code block after "Current memories"
+            if not existing_memories:
+                marker_idx = content.find("Current memories")
+                if marker_idx >= 0:
+                    extracted_memories = _safe_loads(_extract_codeblock(content, marker_idx))
+                    if isinstance(extracted_memories, list):
+                        existing_memories = extracted_memories
+            # JSON object inside the code block after "Chat metadata"
+            if not chat_metadata:
+                marker_idx = content.find("Chat metadata")
+                if marker_idx >= 0:
+                    extracted_metadata = _safe_loads(_extract_codeblock(content, marker_idx))
+                    if isinstance(extracted_metadata, dict):
+                        chat_metadata = extracted_metadata
+    except Exception as e:
+        st.warning(f"Error extracting chat context: {e}")
+
+    return {
+        "system_prompt": "\n\n".join(system_parts),
+        "chat_history": chat_history,
+        "existing_memories": existing_memories,
+        "chat_metadata": chat_metadata,
+    }
+
+@st.cache_data(max_entries=512)
+def _record_context(content_key, _messages):
+    """Cached _extract_context for a record, keyed on its content_key rather than its observation_id."""
+    return _extract_context(_messages)
+
+def _materialize_record(record, context):
+    """Returns the full record as displayed and exported, with its context fields in place of the raw messages."""
+    return {
+        "observation_id": record.get("observation_id"),
+        "llm_output": record.get("llm_output"),
+        **context,
+        "alert_type": record.get("alert_type"),
+    }
+
 # --- Function to Apply Filter ---
 def apply_filter():
     """
@@ -277,60 +427,189 @@ def go_next():
 
 def normalize_whitespace(text: Optional[str]) -> Optional[str]:
     if not isinstance(text, str): return text
-    parts = text.split()
-    return ' '.join(parts) if parts else ''
+    return _WS_RE.sub(' ', text).strip()
 
-def format_chat_history(chat_history):
+@functools.lru_cache(maxsize=8192)
+def _fmt_ts(ts: str) -> str:
+    """Convert an ISO timestamp to READABLE_TIMESTAMP_FORMAT, returning it unchanged if unparseable."""
+    try:
+        return datetime.fromisoformat(ts.replace('Z', '+00:00')).strftime(READABLE_TIMESTAMP_FORMAT)
+    except ValueError:
+        return ts
+
+@st.cache_data(max_entries=512)
+def format_chat_history(content_key, _chat_history):
+    # Cached on the record's content key; the leading underscore keeps Streamlit from hashing the history itself
+    # Returns one pre-joined markdown string so the caller emits a single element per record
+    chat_history = _chat_history
     display_lines = []
-    if not isinstance(chat_history, list): return ["Invalid chat history format."]
+    append = display_lines.append
+    if not isinstance(chat_history, list): return "Invalid chat history format."
     for msg in chat_history:
         name = msg.get("name", "Unknown")
         role = msg.get("role", "Unknown")
         timestamp_str = msg.get("createdAt", "")
         message = msg.get("message", "*No message content*")
         actor_id = msg.get("actorId", "")
-        readable_timestamp = "Invalid Timestamp"
-        if timestamp_str:
-            try:
-                dt_object = datetime.fromisoformat(timestamp_str.replace('Z', '+00:00'))
-                readable_timestamp = dt_object.strftime(READABLE_TIMESTAMP_FORMAT)
-            except ValueError: readable_timestamp = timestamp_str
+        readable_timestamp = _fmt_ts(timestamp_str) if timestamp_str else "Invalid Timestamp"
         # Use brand color for the name to make it stand out
-        display_lines.append(f"<span style='color:{BRAND_COLOR};font-weight:bold;'>{name} ({role})</span> [{readable_timestamp}] *(Actor: {actor_id})*\n> {message}\n---")
-    return display_lines
+        append(f"{_NAME_OPEN}{name} ({role})</span> [{readable_timestamp}] *(Actor: {actor_id})*\n> {message}\n---")
+    return "\n\n".join(display_lines)
+
+@st.cache_data(max_entries=512)
+def _render_output_html(content_key, _llm_output, has_memory):
+    """Builds the "Delphi's Output" box for a record, highlighting MEMORY tags when has_memory is set. Cached on content_key."""
+    # Style the output box with a light version of the brand color
+    output_bg_color = "rgba(223, 0, 116, 0.05)"
+    output_border_color = "rgba(223, 0, 116, 0.3)"
+    # Escape the raw output so only our highlight spans are interpreted as HTML
+    output_text = str(_llm_output).translate(_HTML_ESC)
+    if has_memory:
+        # Highlight memory tags in the output with brand color
+        output_text = _MEM_TAG_RE.sub(lambda m: _MEM_TAG_SUB[m.group(1)], output_text)
+    return f"""
+        <div style='background-color:{output_bg_color};padding:15px;border-radius:5px;border-left:3px solid {output_border_color};'>
+            {output_text}
+        </div>
+    """
+
+@st.cache_data(max_entries=512)
+def _render_metadata_json(content_key, _metadata):
+    """Pretty-prints a record's chat metadata as indented JSON. Cached on content_key."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(_metadata, option=orjson.OPT_INDENT_2).decode('utf-8')
+        except TypeError:
+            pass
+    return json.dumps(_metadata, indent=2, ensure_ascii=False)
+
+@st.cache_data(max_entries=512)
+def _render_memories_html(content_key, _memories):
+    """Builds the existing-memories list for a record as a single HTML block. Cached on content_key."""
+    blocks = []
+    for mem in _memories:
+        ts_str = mem.get('createdAt', '')
+        ts_readable = _fmt_ts(ts_str) if ts_str else ts_str
+        blocks.append(f"""
+        <div style='margin-bottom:8px;padding:5px;border-left:2px solid {BRAND_COLOR};padding-left:10px;'>
+            <code>{mem.get('memory', 'N/A')}</code>
+            <div style='font-size:0.8rem;color:#666;'>
+                Card: {mem.get('cardId')}, Reply: {mem.get('replyId', 'N/A')}, Time: {ts_readable}
+            </div>
+        </div>""")
+    return "".join(blocks)
+
+def _widget_keys(record_id):
+    """Session state keys for a record's classification, correct-memory and critique widgets."""
+    return (f"label_classification_{record_id}", f"correct_mem_{record_id}", f"critique_{record_id}")
 
 def save_labels_to_state(current_index, record_id):
-    if 'labels' not in st.session_state: st.session_state.labels = {}
-    classification_key = f"label_classification_{record_id}"
-    classification_value = st.session_state.get(classification_key, LABEL_CLASSIFICATIONS[-1])
+    """Saves the record's widget values into st.session_state.labels."""
+    state = st.session_state  # Resolve the session state proxy once for the reads below
+    classification_key, correct_mem_key, critique_key = _widget_keys(record_id)
+    classification_value = state.get(classification_key, LABEL_CLASSIFICATIONS[-1])
+    critique_value = state.get(critique_key, "")
+    correct_mem_value = state.get(correct_mem_key, "")
+    # Leave an unchanged label alone so navigation doesn't re-stamp it
+    if 'labels' not in state: state.labels = {}
+    previous = state.labels.get(record_id)
+    if previous and (
+        previous.get("human_label_classification") == classification_value
+        and previous.get("human_label_critique") == critique_value
+        and previous.get("human_label_correct_memory_optional") == correct_mem_value
+    ):
+        return
     current_labels = {
-        "human_label_timestamp": datetime.now(timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z'),
+        "human_label_timestamp": _utc_now_iso(),
         "human_label_classification": classification_value,
-        "human_label_critique": st.session_state.get(f"critique_{record_id}", ""),
-        "human_label_correct_memory_optional": st.session_state.get(f"correct_mem_{record_id}", ""),
+        "human_label_critique": critique_value,
+        "human_label_correct_memory_optional": correct_mem_value,
     }
-    st.session_state.labels[record_id] = current_labels
+    # Track the labeled count incrementally so the sidebar doesn't rebuild id sets each rerun
+    if previous is None:
+        state.labeled_counter = state.get('labeled_counter', 0) + 1
+    state.labels[record_id] = current_labels
 
 def generate_labeled_data_jsonl():
-    labeled_data = []
-    # Iterate over the original full dataset (all_data)
+    # Stream each encoded line into one buffer rather than holding every line and then a joined copy
+    buffer = io.BytesIO()
+    # Walk only the labeled records, looking each one up in the index built at load time
     if st.session_state.get('all_data') and st.session_state.get('labels'):
-        if not st.session_state.all_data: return ""
-        # Use all_data to ensure all records are considered for saving
-        for record in st.session_state.all_data:
-            record_id = record.get("observation_id")
-            if record_id is None: continue
-            merged_record = record.copy() # Start with original record data
-            # Check if labels exist for this record_id in the state and update
-            if record_id in st.session_state.labels:
-                merged_record.update(st.session_state.labels[record_id])
-                # Only append records that have been labeled during the session
+        records_by_id = st.session_state.get('records_by_id', {})
+        # Encoded lines from earlier reruns, reused until a record's labels are replaced,
+        # so only newly saved records have their prompt context parsed and serialized
+        export_lines = st.session_state.setdefault('_export_lines', {})
+        for record_id, labels in st.session_state.labels.items():
+            cached = export_lines.get(record_id)
+            if cached is not None and cached[0] is labels:
+                line = cached[1]
+            else:
+                record = records_by_id.get(record_id)
+                if record is None: continue
+                context = _record_context(record.get("_content_key"), record.get("_raw_messages", _EMPTY_TUPLE))
+                merged_record = {**_materialize_record(record, context), **labels}
                 try:
-                    labeled_data.append(json.dumps(merged_record, ensure_ascii=False))
+                    line = _dumps(merged_record)
                 except TypeError as e:
                     st.error(f"Error serializing record {record_id}: {e}. Skipping.")
+                    continue
+                export_lines[record_id] = (labels, line)
+            buffer.write(line)
+            buffer.write(b"\n")
+
+    # st.download_button accepts the bytes directly
+    return buffer.getvalue()
+
+def _render_record(current_index, record_id, existing_labels):
+    """
+    Renders the labeling widgets for one record.
+    The inputs sit in a form, so only Save reruns the script.
+    """
+    classification = existing_labels.get("human_label_classification", LABEL_CLASSIFICATIONS[-1])
+    current_classification_index = _CLASSIFICATION_INDEX.get(classification)
+    if current_classification_index is None:
+        current_classification_index = len(LABEL_CLASSIFICATIONS) - 1
+        st.warning(f"Invalid label '{classification}' found for record {record_id}. Resetting to 'I'm not sure 🤔'.")
 
-    return "\n".join(labeled_data)
+    classification_key, correct_mem_key, critique_key = _widget_keys(record_id)
+
+    # Seed the text areas from any saved labels on first render; Streamlit ignores value= once the key exists
+    st.session_state.setdefault(correct_mem_key, existing_labels.get("human_label_correct_memory_optional", ""))
+    st.session_state.setdefault(critique_key, existing_labels.get("human_label_critique", ""))
+
+    # Batch the inputs in a form so edits are only committed, and saved, on submit
+    with st.form(f"rec_form_{record_id}", border=False):
+        st.radio(
+            "**How did Delphi do?**",
+            options=LABEL_CLASSIFICATIONS,
+            key=classification_key,
+            index=current_classification_index,
+            horizontal=True,
+        )
+
+        st.text_area(
+            "**Optional:** Correct Memory Text (If you think there's a better version)",
+            key=correct_mem_key,
+            height=100,
+            help="If Delphi missed something, what would have been the correct <MEMORY> tag?",
+        )
+
+        st.text_area(
+            "Your Feedback (Any additional thoughts or explanations)",
+            key=critique_key,
+            height=100,
+        )
+
+        st.form_submit_button(
+            "Save",
+            on_click=save_labels_to_state,
+            args=(current_index, record_id)
+        )
+        # Form values only reach session state on submit, so Previous/Next can't save unsubmitted edits
+        st.caption("Unsaved edits are discarded when you navigate to another record. Click **Save** first.")
+    
+    # Add a subtle branded footer to each record view
+    st.html(_FOOTER_HTML)
 
 
 # --- Streamlit App Layout ---
@@ -341,10 +620,7 @@ st.set_page_config(layout="wide", page_title="Visory AI Memory Labelling Tool")
 apply_custom_styling()
 
 # Add branded logo - this always shows
-st.markdown(f"""
-    <h1 style='color:{BRAND_COLOR};'>Visory AI Memory Labelling Tool</h1>
-    <h2 style='color:{BRAND_COLOR};text-align:center;'>🌟 Welcome to Visory's Delphi AI Memory Labelling Tool! 🌟</h2>
-""", unsafe_allow_html=True)
+st.markdown(_WELCOME_HTML, unsafe_allow_html=True)
 
 # Determine if instructions should be expanded by default
 # (expanded when no file is loaded, collapsed when a file is loaded)
@@ -352,31 +628,11 @@ show_instructions = len(st.session_state.get('data', [])) == 0
 
 # Put instructions in an expander
 with st.expander("How to use this tool", expanded=show_instructions):
-    st.markdown(f"""
-        <p>Hi there, valued expert! We're excited you're here to help Delphi, our clever AI assistant, get smarter at recognising useful memories.</p>
-        
-        <p style='color:{BRAND_COLOR};font-weight:bold;margin-top:20px;'>🚀 How to Jump In:</p>
-        <p>1. <b>📁 Upload Your Document</b> Use the sidebar on the left to upload your JSONL file. Each line should be a neatly formatted JSON object representing an AI conversation.</p>
-        
-        <p>2. <b>🔍 Review Delphi's Memory</b> You'll see one memory at a time, including Delphi's determination about whether it's useful.</p>
-        
-        <p>3. <b>✅ Label Delphi's Decision</b> Help Delphi learn by telling it how it did:</p>
-        <p style='margin-left:20px;'><b>Correct 👍</b>: Delphi nailed it!</p>
-        <p style='margin-left:20px;'><b>Incorrect 👎</b>: Delphi missed the mark.</p>
-        <p style='margin-left:20px;'><b>I'm not sure 🤔</b>: If it's unclear, that's totally fine!</p>
-        
-        <p>4. <b>💬 Optional Critiques</b> If you'd like, you can leave notes to explain your choice or provide helpful feedback. Your insights are gold to us!</p>
-        
-        <p>5. <b>↔️ Easy Navigation</b> Click the <b>Right Arrow</b> ➡️ to move forward and the <b>Left Arrow</b> ⬅️ to revisit previous entries.</p>
-        
-        <p>6. <b>📥 All Done? Download & Submit!</b> Once you've reviewed all memories, hit <b>"Download Labelled Data"</b>. Then simply email the file to <b>Ben Field at ben.field@visory.com.au</b>.</p>
-        
-        <p style='text-align:center;margin-top:20px;'><b>🎉 Thank you for lending your expertise! Together, we're making Delphi even more brilliant! 🎉</b></p>
-    """, unsafe_allow_html=True)
+    st.markdown(_INSTRUCTIONS_HTML, unsafe_allow_html=True)
 
 # --- Sidebar ---
 with st.sidebar:
-    st.markdown(f"<h3 style='color:{BRAND_COLOR};'>Navigation Control</h3>", unsafe_allow_html=True)
+    st.markdown(_H3_OPEN + "Navigation Control</h3>", unsafe_allow_html=True)
     
     uploaded_file = st.file_uploader(
         "Choose processed/labeled JSONL file",
@@ -392,6 +648,8 @@ with st.sidebar:
     # Initialize session state variables robustly
     st.session_state.setdefault('data', [])
     st.session_state.setdefault('all_data', [])
+    st.session_state.setdefault('records_by_id', {})
+    st.session_state.setdefault('labeled_counter', 0)
     st.session_state.setdefault('index', 0)
     st.session_state.setdefault('labels', {})
     st.session_state.setdefault('filter_positives', False)  # Kept for compatibility
@@ -406,15 +664,22 @@ with st.sidebar:
 
             if loaded_data:
                 st.session_state.all_data = loaded_data
+                # Build the observation_id lookup once per upload, alongside the data it indexes
+                st.session_state.records_by_id = {r['observation_id']: r for r in loaded_data if r.get('observation_id')}
                 st.session_state.labels = loaded_labels
+                st.session_state._export_lines = {}
+                st.session_state.labeled_counter = len(loaded_labels)
                 st.session_state.current_file_id = uploaded_file.file_id
                 st.session_state.current_file_name = uploaded_file.name
                 apply_filter()
                 # No success messages about loading records
             else:
                 st.session_state.all_data = []
+                st.session_state.records_by_id = {}
+                st.session_state.labeled_counter = 0
                 st.session_state.data = []
                 st.session_state.labels = {}
+                st.session_state._export_lines = {}
                 st.session_state.current_file_id = None
                 st.session_state.current_file_name = None
                 st.session_state.index = 0
@@ -422,8 +687,11 @@ with st.sidebar:
     elif st.session_state.current_file_id is not None:
         # Silently clear session state
         st.session_state.all_data = []
+        st.session_state.records_by_id = {}
+        st.session_state.labeled_counter = 0
         st.session_state.data = []
         st.session_state.labels = {}
+        st.session_state._export_lines = {}
         st.session_state.current_file_id = None
         st.session_state.current_file_name = None
         st.session_state.index = 0
@@ -450,11 +718,10 @@ with st.sidebar:
             record = st.session_state.data[current_index]
             record_id = record.get("observation_id", f"UNKNOWN_ID_{current_index}")
 
-        labeled_ids = set(st.session_state.get('labels', {}).keys())
-        labeled_count_total = len(labeled_ids)
+        labeled_count_total = len(st.session_state.get('labels', {}))
 
-        filtered_ids = {r.get("observation_id") for r in st.session_state.data if r.get("observation_id")}
-        labeled_count_filtered = len(filtered_ids.intersection(labeled_ids))
+        # Maintained by save_labels_to_state; the filter is removed so data == all_data
+        labeled_count_filtered = st.session_state.labeled_counter
 
         # Stylish progress information
         if is_filtered:
@@ -502,7 +769,7 @@ with st.sidebar:
 
         st.divider()
 
-        st.markdown(f"<h3 style='color:{BRAND_COLOR};'>Save Progress</h3>", unsafe_allow_html=True)
+        st.markdown(_H3_OPEN + "Save Progress</h3>", unsafe_allow_html=True)
         if st.session_state.get('labels'):
             labeled_jsonl_data = generate_labeled_data_jsonl()
             if labeled_jsonl_data:
@@ -541,6 +808,9 @@ if st.session_state.data:
     if 0 <= current_index < len(st.session_state.data):
         record = st.session_state.data[current_index]
         record_id = record.get("observation_id", f"UNKNOWN_ID_{current_index}")
+        content_key = record.get("_content_key")
+        # Parse the prompt context only for the record on screen
+        record = _materialize_record(record, _record_context(content_key, record.get("_raw_messages", _EMPTY_TUPLE)))
 
         # Stylish record header
         st.markdown(f"""
@@ -551,29 +821,8 @@ if st.session_state.data:
         """, unsafe_allow_html=True)
 
         # Enhanced LLM Output box
-        st.markdown(f"<h4 style='color:{BRAND_COLOR};'>Delphi's Output:</h4>", unsafe_allow_html=True)
-        
-        # Style the output box with a light version of the brand color
-        output_bg_color = "rgba(223, 0, 116, 0.05)"
-        output_border_color = "rgba(223, 0, 116, 0.3)"
-        
-        if "<MEMORY" in record.get('llm_output', ''):
-            # Highlight memory tags in the output with brand color
-            output_text = record.get('llm_output', '*No Output Recorded*')
-            # Safely replace with HTML highlighting
-            output_text = output_text.replace("<MEMORY", f"<span style='color:{BRAND_COLOR};font-weight:bold;'>&lt;MEMORY")
-            output_text = output_text.replace("</MEMORY>", f"&lt;/MEMORY&gt;</span>")
-            st.markdown(f"""
-                <div style='background-color:{output_bg_color};padding:15px;border-radius:5px;border-left:3px solid {output_border_color};'>
-                    {output_text}
-                </div>
-            """, unsafe_allow_html=True)
-        else:
-            st.markdown(f"""
-                <div style='background-color:{output_bg_color};padding:15px;border-radius:5px;border-left:3px solid {output_border_color};'>
-                    {record.get('llm_output', '*No Output Recorded*')}
-                </div>
-            """, unsafe_allow_html=True)
+        st.markdown(_H4_OPEN + "Delphi's Output:</h4>", unsafe_allow_html=True)
+        st.markdown(_render_output_html(content_key, record.get('llm_output', '*No Output Recorded*'), record.get('alert_type') == 'memory'), unsafe_allow_html=True)
 
         # Stylish expandable sections
         with st.expander("View System Prompt"):
@@ -582,94 +831,25 @@ if st.session_state.data:
         col_meta, col_mem = st.columns(2)
         with col_meta:
             with st.expander("View Chat Metadata", expanded=False):
-                st.json(record.get('chat_metadata', {}))
+                st.code(_render_metadata_json(content_key, record.get('chat_metadata', {})), language='json')
         with col_mem:
             with st.expander(f"View Existing Memories ({len(record.get('existing_memories',[]))})", expanded=False):
                  memories = record.get('existing_memories', [])
                  if memories:
-                     for mem in memories:
-                          ts_str = mem.get('createdAt', '')
-                          ts_readable = ts_str
-                          if ts_str:
-                               try:
-                                    dt_obj = datetime.fromisoformat(ts_str.replace('Z', '+00:00'))
-                                    ts_readable = dt_obj.strftime(READABLE_TIMESTAMP_FORMAT)
-                               except ValueError:
-                                    pass
-                          st.markdown(f"""
-                              <div style='margin-bottom:8px;padding:5px;border-left:2px solid {BRAND_COLOR};padding-left:10px;'>
-                                  <code>{mem.get('memory', 'N/A')}</code>
-                                  <div style='font-size:0.8rem;color:#666;'>
-                                      Card: {mem.get('cardId')}, Reply: {mem.get('replyId', 'N/A')}, Time: {ts_readable}
-                                  </div>
-                              </div>
-                          """, unsafe_allow_html=True)
+                     st.markdown(_render_memories_html(content_key, memories), unsafe_allow_html=True)
                  else:
                       st.write("None")
 
         # Enhanced chat history display
-        st.markdown(f"<h4 style='color:{BRAND_COLOR};'>Chat History:</h4>", unsafe_allow_html=True)
+        st.markdown(_H4_OPEN + "Chat History:</h4>", unsafe_allow_html=True)
         chat_display_area = st.container(height=400, border=True)
-        formatted_history = format_chat_history(record.get('chat_history', []))
-        for line in formatted_history:
-            chat_display_area.markdown(line, unsafe_allow_html=True)
+        formatted_history = format_chat_history(content_key, record.get('chat_history', []))
+        chat_display_area.markdown(formatted_history, unsafe_allow_html=True)
 
         st.divider()
 
         # --- Stylish Labeling Inputs with simplified options ---
-        st.markdown(f"<h3 style='color:{BRAND_COLOR};'>Your Assessment</h3>", unsafe_allow_html=True)
+        st.markdown(_H3_OPEN + "Your Assessment</h3>", unsafe_allow_html=True)
 
         existing_labels = st.session_state.get('labels', {}).get(record_id, {})
-        try:
-            classification = existing_labels.get("human_label_classification", LABEL_CLASSIFICATIONS[-1])
-            current_classification_index = LABEL_CLASSIFICATIONS.index(classification)
-        except ValueError:
-            current_classification_index = len(LABEL_CLASSIFICATIONS) - 1
-            st.warning(f"Invalid label '{classification}' found for record {record_id}. Resetting to 'I'm not sure 🤔'.")
-
-        st.radio(
-            "**How did Delphi do?**",
-            options=LABEL_CLASSIFICATIONS,
-            key=f"label_classification_{record_id}",
-            index=current_classification_index,
-            horizontal=True,
-            on_change=save_labels_to_state,
-            args=(current_index, record_id)
-        )
-
-        st.text_area(
-            "**Optional:** Correct Memory Text (If you think there's a better version)",
-            key=f"correct_mem_{record_id}",
-            value=existing_labels.get("human_label_correct_memory_optional", ""),
-            height=None,
-            help="If Delphi missed something, what would have been the correct <MEMORY> tag?",
-            on_change=save_labels_to_state,
-            args=(current_index, record_id)
-        )
-
-        # Critique text area with brand-colored border
-        st.markdown(f"""
-            <style>
-                div[data-testid="stTextArea"] textarea {{
-                    border-left: 2px solid {BRAND_COLOR} !important;
-                }}
-            </style>
-        """, unsafe_allow_html=True)
-        
-        st.text_area(
-            "Your Feedback (Any additional thoughts or explanations)",
-            key=f"critique_{record_id}",
-            value=existing_labels.get("human_label_critique", ""),
-            height=100,
-            on_change=save_labels_to_state,
-            args=(current_index, record_id)
-        )
-        
-        # Add a subtle branded footer to each record view
-        st.markdown(f"""
-            <div style='text-align:center;margin-top:30px;padding-top:10px;border-top:1px solid #eee;'>
-                <p style='color:#666;font-size:0.8rem;'>
-                    Visory AI Alert Labeling Tool | <span style='color:{BRAND_COLOR};'>Your feedback improves our system</span>
-                </p>
-            </div>
-        """, unsafe_allow_html=True)
+        _render_record(current_index, record_id, existing_labels)